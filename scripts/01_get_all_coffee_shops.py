@@ -1,95 +1,298 @@
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
 import csv
+import os
+import orjson
 import time
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import geopandas as gpd
 import numpy as np
+import shapely
+from shapely.geometry import box
 
 # --- CONFIGURATION ---
 # IMPORTANT: Replace with your actual Google Places API Key
 API_KEY = ''
 # The type of place to search for
 TYPE = 'cafe'
-# The radius for each individual search in our grid (in meters).
-# Smaller is more detailed but uses more API calls. 2000m (2km) is a good start.
-RADIUS = 2000
+# The search radius range for the adaptive grid (in meters).
+# We start with large circles and only split a cell into 4 smaller ones when its
+# search comes back full (60 results), so sparse areas cost very few API calls.
+MAX_RADIUS = 8000
+MIN_RADIUS = 500
+# Google returns at most 60 results (3 pages of 20) for a single search
+PAGE_LIMIT = 60
+# How many times a cell whose search failed is tried again before giving up on it
+MAX_RETRIES = 3
+PLACES_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+# The Places API reports errors (e.g. REQUEST_DENIED, OVER_QUERY_LIMIT) with HTTP 200, so check the body status too
+OK_STATUSES = ('OK', 'ZERO_RESULTS')
 # The file containing the boundaries of our search area
 TRACTS_SHP_PATH = "riverside_county_tracts.shp"
+# The dissolved county outline is cached here (rebuilt automatically when the tracts file changes)
+COUNTY_BOUNDARY_PATH = "riverside_county_boundary.parquet"
 OUTPUT_CSV_FILENAME = "riverside_coffee_shops_comprehensive.csv"
+CSV_FIELDS = ['place_id', 'name', 'address', 'latitude', 'longitude', 'rating', 'review_count']
+# API responses are cached here so re-runs (or resuming after a crash) don't pay for the same calls again
+PLACES_CACHE_PATH = "places_cache.sqlite"
+CACHE_EXPIRE_AFTER = timedelta(days=7)
+# Number of grid points fetched at the same time
+MAX_WORKERS = 16
+# Maximum requests per second sent to the Places API (shared by all workers)
+MAX_QPS = 10
 # --- END CONFIGURATION ---
 
-def fetch_places(api_key, location_str, radius, place_type):
-    """Fetches up to 60 places for a single location point."""
-    url = (
-        f"https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-        f"?location={location_str}&radius={radius}&type={place_type}&key={api_key}"
+class RateLimiter:
+    """A simple thread-safe token bucket that allows `rate` calls per second."""
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until a token is available, then consumes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                sleep_for = (1 - self.tokens) / self.rate
+            time.sleep(sleep_for)
+
+def is_successful_response(response):
+    """Only lets successful Places responses into the cache, never error replies."""
+    try:
+        return orjson.loads(response.content).get('status') in OK_STATUSES
+    except orjson.JSONDecodeError:
+        return False
+
+def create_session(pool_size):
+    """Creates a cached requests Session whose connection pool is shared by all workers."""
+    session = requests_cache.CachedSession(
+        PLACES_CACHE_PATH,
+        expire_after=CACHE_EXPIRE_AFTER,
+        ignored_parameters=['key'], # Keep the API key out of the cache
+        filter_fn=is_successful_response,
     )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_places(api_key, location_str, radius, place_type, session, rate_limiter=None):
+    """Fetches up to 60 places for a single location point.
+
+    Returns (results, ok). `ok` is False if any page failed, in which case `results` may be incomplete.
+    """
+    first_page_params = {'location': location_str, 'radius': radius, 'type': place_type, 'key': api_key}
+    params = first_page_params
     
     results = []
     page_count = 0
-    while url and page_count < 3: # Google allows up to 3 pages (20 results each)
+    previous_from_cache = False
+    force_refresh = False
+    while params and page_count < 3: # Google allows up to 3 pages (20 results each)
         try:
-            response = requests.get(url)
+            # Try the cache first, so cached pages are served from disk without using up the rate limit
+            response = None
+            if not force_refresh:
+                response = session.get(PLACES_URL, params=params, timeout=10, only_if_cached=True)
+                if response.status_code == 504: # Not cached
+                    response = None
+            if response is None:
+                if previous_from_cache:
+                    # A token from a cached page may be days old, so start over from page 1
+                    # over the network to get a fresh one
+                    params = first_page_params
+                    results = []
+                    page_count = 0
+                    previous_from_cache = False
+                    force_refresh = True
+                    continue
+                if rate_limiter:
+                    rate_limiter.wait()
+                response = session.get(PLACES_URL, params=params, timeout=10, force_refresh=force_refresh)
             response.raise_for_status() # Raise an exception for bad status codes
-            data = response.json()
-        except requests.exceptions.RequestException as e:
+            data = orjson.loads(response.content)
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             print(f"  Error fetching data: {e}")
-            break
+            return results, False
+
+        status = data.get('status')
+        if status not in OK_STATUSES:
+            print(f"  Places API error: {status} {data.get('error_message', '')}")
+            return results, False
 
-        for place in data.get('results', []):
-            results.append({
+        results.extend(
+            {
                 # place_id is the best unique identifier for de-duplication
-                'place_id': place.get('place_id'), 
+                'place_id': place.get('place_id'),
                 'name': place.get('name'),
                 'address': place.get('vicinity'),
                 'latitude': place['geometry']['location']['lat'],
                 'longitude': place['geometry']['location']['lng'],
                 'rating': place.get('rating'),
-                'review_count': place.get('user_ratings_total')
-            })
+                'review_count': place.get('user_ratings_total'),
+            }
+            for place in data.get('results', ())
+        )
 
         next_page_token = data.get('next_page_token')
         page_count += 1
+        previous_from_cache = getattr(response, 'from_cache', False)
         if next_page_token:
-            time.sleep(2)  # Required delay before fetching the next page
-            url = (
-                f"https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-                f"?pagetoken={next_page_token}&key={api_key}"
-            )
+            # Required delay before a fresh token can be used (a cached token is only used against the cache)
+            if not previous_from_cache:
+                time.sleep(2)
+            params = {'pagetoken': next_page_token, 'key': api_key}
         else:
-            url = None
+            params = None
             
-    return results
+    return results, True
 
-def save_to_csv(data, filename):
-    """Saves a list of dictionaries to a CSV file."""
-    if not data:
-        print("No data to save.")
-        return
-        
-    with open(filename, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=data[0].keys())
-        writer.writeheader()
-        writer.writerows(data)
+def load_seen_place_ids(filename):
+    """Returns the place_ids already saved in the CSV, so an interrupted run can resume."""
+    if not os.path.exists(filename):
+        return set()
+    with open(filename, newline='', encoding='utf-8') as f:
+        return {row['place_id'] for row in csv.DictReader(f)}
+
+def append_new_places(writer, places, seen_place_ids):
+    """Writes the places we haven't seen before and returns how many were written."""
+    written = 0
+    for place in places:
+        # Use place_id as the unique key to avoid duplicates
+        if place['place_id'] not in seen_place_ids:
+            seen_place_ids.add(place['place_id'])
+            writer.writerow(place)
+            written += 1
+    return written
+
+def load_county_boundary():
+    """Returns the county outline in lat/lon, dissolving the tracts only if it isn't cached yet."""
+    # The cache records which shapefile (and which version of it) it was built from
+    source_path = os.path.abspath(TRACTS_SHP_PATH)
+    source_mtime = os.path.getmtime(TRACTS_SHP_PATH)
+    if os.path.exists(COUNTY_BOUNDARY_PATH):
+        cached = gpd.read_parquet(COUNTY_BOUNDARY_PATH)
+        is_current = (
+            {'source_path', 'source_mtime'} <= set(cached.columns)
+            and cached['source_path'].iloc[0] == source_path
+            and cached['source_mtime'].iloc[0] == source_mtime
+        )
+        if is_current:
+            return cached.to_crs("EPSG:4326").geometry.iloc[0]
+        print(f"'{TRACTS_SHP_PATH}' has changed, rebuilding the county boundary...")
 
-def create_search_grid(gdf, radius_m):
-    """Creates a grid of lat/lon points covering the GeoDataFrame's total bounds."""
+    # Only the geometry is needed to define the search area
+    tracts_gdf = gpd.read_file(TRACTS_SHP_PATH, engine='pyogrio', columns=[])
+    county = gpd.GeoSeries([tracts_gdf.union_all()], crs=tracts_gdf.crs)
+    # Reproject just the dissolved outline (not every tract) to a standard lat/lon CRS, if needed
+    if county.crs != "EPSG:4326":
+        county = county.to_crs("EPSG:4326")
+    gpd.GeoDataFrame(
+        {'source_path': [source_path], 'source_mtime': [source_mtime]},
+        geometry=county,
+    ).to_parquet(COUNTY_BOUNDARY_PATH)
+    print(f"Saved the county boundary to '{COUNTY_BOUNDARY_PATH}'.")
+    return county.iloc[0]
+
+def create_search_grid(bounds, radius_m, county_geom):
+    """Creates a grid of (lat, lon) points whose search cells overlap the county."""
     # Convert radius from meters to degrees (approximate)
     # 1 degree of latitude is roughly 111,111 meters
     radius_deg = radius_m / 111111.0
     
-    # Get the total bounds of our search area
-    minx, miny, maxx, maxy = gdf.total_bounds
+    # The (minx, miny, maxx, maxy) lon/lat bounds of our search area
+    minx, miny, maxx, maxy = bounds
     
     # Create grid points with spacing based on the radius
-    x_coords = np.arange(minx, maxx, radius_deg * 1.5) # Overlap circles slightly
-    y_coords = np.arange(miny, maxy, radius_deg * 1.5)
-    
-    grid_points = []
-    for x in x_coords:
-        for y in y_coords:
-            grid_points.append(f"{y},{x}") # Format as "latitude,longitude"
-            
-    return grid_points
+    step = radius_deg * 1.5 # Overlap circles slightly
+    # Go one step past the max bounds so the north and east edges are covered too
+    x_coords = np.arange(minx, maxx + step, step)
+    y_coords = np.arange(miny, maxy + step, step)
+    xs, ys = np.meshgrid(x_coords, y_coords, indexing='xy')
+    lons, lats = xs.ravel(), ys.ravel()
+
+    # Drop points whose cells lie completely outside the county in one vectorized test
+    half_size = 0.75 * radius_deg
+    cells = shapely.box(lons - half_size, lats - half_size, lons + half_size, lats + half_size)
+    inside = shapely.intersects(county_geom, cells)
+
+    return list(zip(lats[inside], lons[inside])) # Stored as (latitude, longitude)
+
+def cell_box(lat, lon, radius_m):
+    """Returns the square cell searched by a circle of `radius_m` at (lat, lon)."""
+    # Grid points are spaced 1.5 radii apart, so each cell extends 0.75 radii from its center
+    half_size = 0.75 * radius_m / 111111.0
+    return box(lon - half_size, lat - half_size, lon + half_size, lat + half_size)
+
+def split_cell(lat, lon, radius_m):
+    """Splits a cell into 4 quadrants, each searched with half the radius."""
+    offset = 0.75 * radius_m / 111111.0 / 2
+    child_radius = radius_m / 2
+    return [
+        (lat + d_lat, lon + d_lon, child_radius)
+        for d_lat in (-offset, offset)
+        for d_lon in (-offset, offset)
+    ]
+
+def adaptive_search(api_key, seed_points, county_geom, max_radius_m, min_radius_m, place_type, session, rate_limiter,
+                    writer, output_file, seen_place_ids):
+    """Searches the seed grid, subdividing any cell whose search hits the result limit.
+
+    The seed points are expected to be pre-filtered to the county (see `create_search_grid`).
+    New places are appended to the CSV as each cell finishes; returns how many were written.
+    """
+    new_places = 0
+    failed_cells = []
+    # Each queued cell is (lat, lon, radius, attempt)
+    queue = [(lat, lon, max_radius_m, 1) for lat, lon in seed_points]
+    level = 0
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        while queue:
+            print(f"\n--- Searching {len(queue)} cells in round {level} ---")
+            futures = {
+                executor.submit(fetch_places, api_key, f"{lat},{lon}", radius, place_type, session, rate_limiter): (lat, lon, radius, attempt)
+                for lat, lon, radius, attempt in queue
+            }
+            queue = []
+            for i, future in enumerate(as_completed(futures)):
+                lat, lon, radius, attempt = futures[future]
+                places_found, ok = future.result()
+                print(f"--> Cell {i+1}/{len(futures)} at location {lat},{lon} (radius {radius:.0f}m): found {len(places_found)} results.")
+                new_places += append_new_places(writer, places_found, seen_place_ids)
+                output_file.flush() # Keep the CSV up to date in case the run is interrupted
+
+                # A failed search may have stopped early, so its result count says nothing about density
+                if not ok:
+                    if attempt < MAX_RETRIES:
+                        queue.append((lat, lon, radius, attempt + 1))
+                    else:
+                        print(f"  WARNING: Giving up on cell {lat},{lon} (radius {radius:.0f}m) after {attempt} failed attempts.")
+                        failed_cells.append((lat, lon, radius))
+                    continue
+
+                # A full result set means there may be more places here, so search it in finer detail
+                if len(places_found) >= PAGE_LIMIT:
+                    if radius / 2 >= min_radius_m:
+                        queue.extend(
+                            (*cell, 1) for cell in split_cell(lat, lon, radius)
+                            if county_geom.intersects(cell_box(*cell))
+                        )
+                    else:
+                        print(f"  WARNING: Cell {lat},{lon} is still full at the minimum radius; some places may be missing.")
+            level += 1
+
+    if failed_cells:
+        print(f"\nWARNING: {len(failed_cells)} cells could not be searched. Re-run the script to retry them.")
+    return new_places
 
 if __name__ == "__main__":
     if API_KEY == 'YOUR_API_KEY_HERE' or not API_KEY:
@@ -97,36 +300,36 @@ if __name__ == "__main__":
     else:
         print("--- Starting Comprehensive Data Collection ---")
         
-        # 1. Load our map to define the search area
+        # 1. Load the county outline to define the search area
         print(f"Loading search area boundary from '{TRACTS_SHP_PATH}'...")
         try:
-            tracts_gdf = gpd.read_file(TRACTS_SHP_PATH)
-            # Ensure it's in a standard lat/lon CRS for bounds calculation
-            tracts_gdf = tracts_gdf.to_crs("EPSG:4326")
+            county_geom = load_county_boundary()
         except Exception as e:
             print(f"ERROR: Could not load shapefile '{TRACTS_SHP_PATH}'. {e}")
             exit()
 
-        # 2. Create the grid of search points
-        search_grid = create_search_grid(tracts_gdf, RADIUS)
-        print(f"Created a search grid with {len(search_grid)} points to cover Riverside County.")
+        # 2. Create the coarse grid of search points
+        search_grid = create_search_grid(county_geom.bounds, MAX_RADIUS, county_geom)
+        print(f"Created a coarse search grid with {len(search_grid)} points to cover Riverside County.")
         
-        # 3. Iterate through the grid and fetch data
-        all_places = {} # Use a dictionary to handle duplicates automatically
-        for i, location_point in enumerate(search_grid):
-            print(f"--> Searching grid point {i+1}/{len(search_grid)} at location {location_point}...")
-            places_found = fetch_places(API_KEY, location_point, RADIUS, TYPE)
-            print(f"  Found {len(places_found)} results for this point.")
-            for place in places_found:
-                # Use place_id as the unique key to avoid duplicates
-                all_places[place['place_id']] = place
+        # 3. Resume from any places already saved by a previous run
+        seen_place_ids = load_seen_place_ids(OUTPUT_CSV_FILENAME)
+        if seen_place_ids:
+            print(f"Resuming: {len(seen_place_ids)} places already saved in '{OUTPUT_CSV_FILENAME}'.")
         
-        # 4. Convert the dictionary of unique places back to a list
-        final_results = list(all_places.values())
+        # 4. Fetch the grid concurrently, refining dense areas as we go, and stream new places to the CSV
+        session = create_session(MAX_WORKERS)
+        rate_limiter = RateLimiter(MAX_QPS)
+        # An empty file (e.g. left by a run killed before anything was written) still needs a header
+        needs_header = not os.path.exists(OUTPUT_CSV_FILENAME) or os.path.getsize(OUTPUT_CSV_FILENAME) == 0
+        with open(OUTPUT_CSV_FILENAME, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            if needs_header:
+                writer.writeheader()
+                f.flush()
+            new_places = adaptive_search(API_KEY, search_grid, county_geom, MAX_RADIUS, MIN_RADIUS, TYPE, session, rate_limiter,
+                                         writer, f, seen_place_ids)
         
         print("\n--- Collection Complete ---")
-        print(f"Retrieved a total of {len(final_results)} unique coffee shops.")
-        
-        # 5. Save the comprehensive data to a new CSV
-        save_to_csv(final_results, OUTPUT_CSV_FILENAME)
+        print(f"Retrieved {new_places} new coffee shops ({len(seen_place_ids)} unique in total).")
         print(f"Saved comprehensive data to '{OUTPUT_CSV_FILENAME}'")
@@ -1,8 +1,15 @@
 import pandas as pd
 import geopandas as gpd
+import numpy as np
+import shapely
+from numba import njit
+import matplotlib
+matplotlib.use('Agg') # Render straight to files so the pipeline never waits on a plot window
 import matplotlib.pyplot as plt
-import requests
+import requests_cache
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
 # --- MASTER CONFIGURATION ---
 ORIGINAL_SHAPEFILE_PATH = "/home/gch93/Downloads/tl_2024/tl_2024_06_tract.shp"
@@ -11,8 +18,25 @@ CENSUS_VARIABLES_TO_GET = "B01003_001E,B19013_001E,B01002_001E"
 CENSUS_API_KEY = ""
 STATE_FIPS = "06"
 COUNTY_FIPS = "065"
+# The ACS release is fixed, so its responses can be cached for a long time
+CENSUS_CACHE_PATH = "census_cache.sqlite"
+CENSUS_CACHE_EXPIRE_AFTER = timedelta(days=365)
+CENSUS_TIMEOUT = 30 # seconds
 # --- END CONFIGURATION ---
 
+def is_census_table(response):
+    """Only lets real Census tables (a JSON list starting with a header row) into the cache.
+
+    Error replies such as the HTML "Invalid Key" page can come back with HTTP 200, and since the
+    key is left out of the cache key, caching them would keep replaying them after the key is fixed.
+    """
+    try:
+        data = response.json()
+    except ValueError:
+        return False
+    return isinstance(data, list) and len(data) > 0 and isinstance(data[0], list) and 'NAME' in data[0]
+
+
 def get_census_data():
     """Calls the Census API and returns a cleaned DataFrame."""
     print("--- Calling Census API... ---")
@@ -23,87 +47,138 @@ def get_census_data():
         f"&in=state:{STATE_FIPS}+county:{COUNTY_FIPS}"
         f"&key={CENSUS_API_KEY}"
     )
-    response = requests.get(api_url)
+    session = requests_cache.CachedSession(
+        CENSUS_CACHE_PATH,
+        expire_after=CENSUS_CACHE_EXPIRE_AFTER,
+        ignored_parameters=['key'], # Keep the API key out of the cache
+        filter_fn=is_census_table,
+    )
+    response = session.get(api_url, timeout=CENSUS_TIMEOUT)
     response.raise_for_status()
     data = response.json()
     
-    df = pd.DataFrame(data[1:], columns=data[0])
-    
     rename_dict = {
         'B01003_001E': 'TotalPopulation',
         'B19013_001E': 'MedianHouseholdIncome',
         'B01002_001E': 'MedianAge',
     }
-    df = df.rename(columns=rename_dict)
+    df = pd.DataFrame(data[1:], columns=data[0]).rename(columns=rename_dict)
     
-    for col in rename_dict.values():
-        df[col] = pd.to_numeric(df[col], errors='coerce')
+    # Convert all the numeric columns in a single pass
+    num_cols = list(rename_dict.values())
+    df[num_cols] = df[num_cols].apply(pd.to_numeric, errors='coerce', downcast='integer')
 
-    df['state'] = df['state'].astype(str).str.zfill(2)
-    df['county'] = df['county'].astype(str).str.zfill(3)
-    df['tract'] = df['tract'].astype(str).str.zfill(6)
-    df['GEOID'] = df['state'] + df['county'] + df['tract']
+    df['GEOID'] = df['state'].str.zfill(2) + df['county'].str.zfill(3) + df['tract'].str.zfill(6)
     
     print("Census data processed successfully.")
     return df[['GEOID', 'TotalPopulation', 'MedianHouseholdIncome', 'MedianAge']]
 
 
+@njit(cache=True)
+def aggregate_shops(tract_idx, ratings, reviews, n_tracts):
+    """Computes ShopCount, AvgRating and TotalReviews per tract in a single pass over the shops.
+
+    Missing ratings are left out of the average and missing review counts count as 0.
+    """
+    shop_count = np.zeros(n_tracts, np.int64)
+    rating_sum = np.zeros(n_tracts, np.float64)
+    rating_count = np.zeros(n_tracts, np.int64)
+    total_reviews = np.zeros(n_tracts, np.float64)
+    for i in range(tract_idx.size):
+        t = tract_idx[i]
+        shop_count[t] += 1
+        if not np.isnan(ratings[i]):
+            rating_sum[t] += ratings[i]
+            rating_count[t] += 1
+        if not np.isnan(reviews[i]):
+            total_reviews[t] += reviews[i]
+
+    # Tracts without any rated shops get an average of 0
+    avg_rating = np.zeros(n_tracts, np.float64)
+    for t in range(n_tracts):
+        if rating_count[t] > 0:
+            avg_rating[t] = rating_sum[t] / rating_count[t]
+    return shop_count, avg_rating, total_reviews
+
+
 def main():
     print("--- Starting Master Script with Weighted Rating ---")
+
+    # Start the Census API call in the background so its network wait overlaps with loading the local files
+    with ThreadPoolExecutor(max_workers=1) as census_executor:
+        census_future = census_executor.submit(get_census_data)
     
-    # STEP 1: Load and filter map data
-    print(f"Loading original shapefile...")
-    try:
-        california_tracts = gpd.read_file(ORIGINAL_SHAPEFILE_PATH)
-        tracts_gdf = california_tracts[california_tracts['COUNTYFP'] == COUNTY_FIPS].copy()
-        tracts_gdf['GEOID'] = tracts_gdf['GEOID'].astype(str).str.strip()
-        print("Tracts map loaded and filtered.")
-    except Exception as e:
-        print(f"ERROR loading shapefile: {e}")
-        return
-
-    # STEP 2: Get demographic data
-    demographics_df = get_census_data()
-
-    # STEP 3: Load and process coffee shop data
-    print(f"Loading coffee shop data...")
-    try:
-        shops_df = pd.read_csv(SHOPS_CSV_PATH)
-        shops_gdf = gpd.GeoDataFrame(
-            shops_df, 
-            geometry=gpd.points_from_xy(shops_df.longitude, shops_df.latitude),
-            crs="EPSG:4326"
-        )
-        shops_gdf = shops_gdf.to_crs(tracts_gdf.crs)
-        print("Coffee shop data loaded.")
-    except Exception as e:
-        print(f"ERROR loading coffee shop data: {e}")
-        return
+        # STEP 1: Load and filter map data
+        print(f"Loading original shapefile...")
+        try:
+            # Let GDAL filter to our county while reading instead of loading all of California
+            tracts_gdf = gpd.read_file(
+                ORIGINAL_SHAPEFILE_PATH,
+                engine='pyogrio',
+                where=f"COUNTYFP = '{COUNTY_FIPS}'",
+                columns=['GEOID', 'COUNTYFP'],
+            )
+            tracts_gdf['GEOID'] = tracts_gdf['GEOID'].astype(str).str.strip()
+            print("Tracts map loaded and filtered.")
+        except Exception as e:
+            print(f"ERROR loading shapefile: {e}")
+            return
+
+        # STEP 2: Load and process coffee shop data
+        print(f"Loading coffee shop data...")
+        try:
+            shops_df = pd.read_csv(SHOPS_CSV_PATH)
+            shops_gdf = gpd.GeoDataFrame(
+                shops_df, 
+                geometry=gpd.points_from_xy(shops_df.longitude, shops_df.latitude),
+                crs="EPSG:4326"
+            )
+            shops_gdf = shops_gdf.to_crs(tracts_gdf.crs)
+            print("Coffee shop data loaded.")
+        except Exception as e:
+            print(f"ERROR loading coffee shop data: {e}")
+            return
+
+        # STEP 3: Get demographic data (waits for the background Census call to finish)
+        demographics_df = census_future.result()
 
     # STEP 4: Perform joins and aggregations
     print("Performing spatial joins and data merges...")
-    shops_with_tract_data = gpd.sjoin(shops_gdf, tracts_gdf, how="inner", predicate="within")
-    aggregated_shops = shops_with_tract_data.groupby('GEOID').agg(
-        ShopCount=('name', 'count'),
-        AvgRating=('rating', 'mean'),
-        TotalReviews=('review_count', 'sum')
-    ).reset_index()
-
-    final_gdf = tracts_gdf.merge(aggregated_shops, on='GEOID', how='left')
-    final_gdf = final_gdf.merge(demographics_df, on='GEOID', how='left')
-
-    fill_values = {'ShopCount': 0, 'AvgRating': 0, 'TotalReviews': 0}
-    final_gdf.fillna(value=fill_values, inplace=True)
+    # Without a predicate the STRtree query only compares bounding boxes, so it works as a cheap MBB
+    # prefilter. Each candidate pair then gets one exact point-in-polygon test on the raw coordinates.
+    tract_index = shapely.STRtree(tracts_gdf.geometry.values)
+    shop_idx, tract_idx = tract_index.query(shops_gdf.geometry.values)
+    shops_x = shops_gdf.geometry.x.to_numpy()
+    shops_y = shops_gdf.geometry.y.to_numpy()
+    inside = shapely.contains_xy(tracts_gdf.geometry.values[tract_idx], shops_x[shop_idx], shops_y[shop_idx])
+    shop_idx, tract_idx = shop_idx[inside], tract_idx[inside]
+
+    # Aggregate per tract straight from the (shop, tract) index pairs, without building a joined table
+    ratings = shops_df['rating'].to_numpy(dtype=np.float64)[shop_idx]
+    reviews = shops_df['review_count'].to_numpy(dtype=np.float64)[shop_idx]
+    shop_count, avg_rating, total_reviews = aggregate_shops(tract_idx, ratings, reviews, len(tracts_gdf))
+
+    # Tracts without any shops get 0 for all three columns
+    tracts_gdf['ShopCount'] = shop_count
+    tracts_gdf['AvgRating'] = avg_rating
+    tracts_gdf['TotalReviews'] = total_reviews
+
+    # GEOIDs are all digits, so join on int64 keys (much cheaper to hash than strings),
+    # then restore the zero-padded string form for the saved outputs
+    final_gdf = tracts_gdf.astype({'GEOID': 'int64'}).merge(
+        demographics_df.astype({'GEOID': 'int64'}), on='GEOID', how='left'
+    )
+    final_gdf['GEOID'] = final_gdf['GEOID'].astype(str).str.zfill(11)
     
     print("Calculating weighted average rating...")
     C = shops_df['rating'].mean()
     m = shops_df['review_count'].quantile(0.75)
-    v = final_gdf['TotalReviews']
-    R = final_gdf['AvgRating']
-    final_gdf['WeightedAvgRating'] = (v / (v + m)) * R + (m / (v + m)) * C
-    
-    # FIX for FutureWarning: Use this method instead of inplace=True for fillna
-    final_gdf['WeightedAvgRating'] = final_gdf['WeightedAvgRating'].fillna(0)
+    v = final_gdf['TotalReviews'].to_numpy()
+    R = final_gdf['AvgRating'].to_numpy()
+    denom = v + m
+    # Same as (v / (v + m)) * R + (m / (v + m)) * C, but in one pass and with no division by zero
+    with np.errstate(divide='ignore', invalid='ignore'):
+        final_gdf['WeightedAvgRating'] = np.where(denom > 0, (v * R + m * C) / denom, 0.0)
     
     print(f"  Global average rating (C): {C:.2f}")
     print(f"  Review threshold (m): {m:.0f} reviews")
@@ -155,12 +230,16 @@ def main():
 
     plt.tight_layout(rect=[0, 0.03, 1, 0.95])
     plt.savefig("final_maps_weighted_rating.png", dpi=150)
+    plt.close('all') # Free the figure memory right away
     print("SUCCESS! Final maps saved to 'final_maps_weighted_rating.png'")
     # --- Save the final processed data to a file ---
     print("Saving final unified data to 'final_processed_data.geojson'...")
     final_gdf.to_file("final_processed_data.geojson", driver='GeoJSON')
     print("SUCCESS! Final dataset saved to 'final_processed_data.geojson'.")
-    plt.show()
+    # The analysis scripts only need the table, so also save it without geometry as Parquet (much faster to load)
+    final_gdf.drop(columns='geometry').to_parquet("final_processed_data.parquet")
+    final_gdf[['GEOID', 'geometry']].to_parquet("final_processed_geom.parquet")
+    print("SUCCESS! Tabular data saved to 'final_processed_data.parquet' and geometry to 'final_processed_geom.parquet'.")
 
 if __name__ == "__main__":
     main()
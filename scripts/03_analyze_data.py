@@ -1,10 +1,13 @@
 import pandas as pd
-import geopandas as gpd
+import matplotlib
+matplotlib.use('Agg') # Render straight to files so the pipeline never waits on a plot window
 import matplotlib.pyplot as plt
 import seaborn as sns
 
 # --- Configuration ---
-PROCESSED_DATA_PATH = "final_processed_data.geojson"
+PROCESSED_DATA_PATH = "final_processed_data.parquet"
+# Only these columns are read from the processed data
+COLUMNS = ['GEOID', 'TotalPopulation', 'MedianHouseholdIncome', 'MedianAge', 'ShopCount', 'AvgRating', 'TotalReviews']
 # --- End Configuration ---
 
 def main():
@@ -12,7 +15,7 @@ def main():
     
     # Load the final dataset
     try:
-        gdf = gpd.read_file(PROCESSED_DATA_PATH)
+        tracts_df = pd.read_parquet(PROCESSED_DATA_PATH, columns=COLUMNS)
         print("Final dataset loaded successfully.")
     except Exception as e:
         print(f"ERROR: Could not load '{PROCESSED_DATA_PATH}'. Please run master_script.py first. {e}")
@@ -23,7 +26,7 @@ def main():
     
     # Select only the numeric columns we're interested in for correlation
     numeric_columns = ['TotalPopulation', 'MedianHouseholdIncome', 'MedianAge', 'ShopCount', 'AvgRating', 'TotalReviews']
-    correlation_matrix = gdf[numeric_columns].corr()
+    correlation_matrix = tracts_df[numeric_columns].corr()
 
     print("Correlation Matrix:")
     print(correlation_matrix)
@@ -33,8 +36,8 @@ def main():
     sns.heatmap(correlation_matrix, annot=True, cmap='coolwarm', fmt=".2f")
     plt.title("Correlation Matrix of Key Variables", fontsize=16)
     plt.savefig("correlation_heatmap.png", dpi=150)
+    plt.close('all') # Free the figure memory right away
     print("\nHeatmap saved to 'correlation_heatmap.png'")
-    plt.show()
 
 
     # --- Analysis 2: Scatter Plots for Key Relationships ---
@@ -44,22 +47,22 @@ def main():
     fig.suptitle('Visualizing Key Relationships', fontsize=16)
 
     # Scatter plot: Income vs. Shop Count
-    sns.scatterplot(data=gdf, x='MedianHouseholdIncome', y='ShopCount', ax=ax1)
+    sns.scatterplot(data=tracts_df, x='MedianHouseholdIncome', y='ShopCount', ax=ax1)
     ax1.set_title("Income vs. Number of Coffee Shops")
     ax1.set_xlabel("Median Household Income ($)")
     ax1.set_ylabel("Number of Shops in Tract")
     ax1.grid(True)
 
     # Scatter plot: Population vs. Shop Count
-    sns.scatterplot(data=gdf, x='TotalPopulation', y='ShopCount', ax=ax2)
+    sns.scatterplot(data=tracts_df, x='TotalPopulation', y='ShopCount', ax=ax2)
     ax2.set_title("Population vs. Number of Coffee Shops")
     ax2.set_xlabel("Total Population")
     ax2.set_ylabel("Number of Shops in Tract")
     ax2.grid(True)
 
     plt.savefig("scatter_plots.png", dpi=150)
+    plt.close('all') # Free the figure memory right away
     print("Scatter plots saved to 'scatter_plots.png'")
-    plt.show()
 
 
     # --- Analysis 3: Programmatically Find "Opportunity Hotspots" ---
@@ -69,14 +72,14 @@ def main():
     # - Population is in the top 25% (75th percentile)
     # - Median Income is in the top 25% (75th percentile)
     # - The number of shops is 0
-    pop_threshold = gdf['TotalPopulation'].quantile(0.75)
-    income_threshold = gdf['MedianHouseholdIncome'].quantile(0.75)
-
-    hotspots_df = gdf[
-        (gdf['TotalPopulation'] >= pop_threshold) &
-        (gdf['MedianHouseholdIncome'] >= income_threshold) &
-        (gdf['ShopCount'] == 0)
-    ]
+    pop_threshold, income_threshold = tracts_df[['TotalPopulation', 'MedianHouseholdIncome']].quantile(0.75)
+
+    # query() evaluates the whole filter with numexpr (when installed) instead of building a mask per condition
+    hotspots_df = tracts_df.query(
+        'TotalPopulation >= @pop_threshold and '
+        'MedianHouseholdIncome >= @income_threshold and '
+        'ShopCount == 0'
+    )
 
     print(f"Criteria for Hotspot: Population >= {int(pop_threshold)}, Income >= ${int(income_threshold)}, and Shop Count == 0")
     print(f"\nFound {len(hotspots_df)} potential hotspot census tracts matching the criteria.")
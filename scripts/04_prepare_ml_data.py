@@ -1,64 +1,56 @@
 import pandas as pd
-import geopandas as gpd
 from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import MinMaxScaler
 import numpy as np
 
 # --- Configuration ---
-PROCESSED_DATA_PATH = "final_processed_data.geojson"
+PROCESSED_DATA_PATH = "final_processed_data.parquet"
 # --- End Configuration ---
 
 def main():
     print("--- Starting Step 6: Preparing Data for Machine Learning ---")
 
-    # 1. Load our final, clean dataset
+    # We'll use the core demographic data to predict the number of shops.
+    features = ['TotalPopulation', 'MedianHouseholdIncome', 'MedianAge']
+    target = 'ShopCount'
+
+    # 1. Load our final, clean dataset (only the columns we need)
     try:
-        gdf = gpd.read_file(PROCESSED_DATA_PATH)
+        tracts_df = pd.read_parquet(PROCESSED_DATA_PATH, columns=features + [target])
         print("Final dataset loaded successfully.")
     except Exception as e:
         print(f"ERROR: Could not load '{PROCESSED_DATA_PATH}'. {e}")
         return
 
     # 2. Select features (X) and the target (y)
-    # We'll use the core demographic data to predict the number of shops.
-    features = ['TotalPopulation', 'MedianHouseholdIncome', 'MedianAge']
-    target = 'ShopCount'
-    
     print(f"\nFeatures (X): {features}")
     print(f"Target (y): {target}")
 
     # Create our X and y dataframes, dropping any rows with missing demographic data
-    df = gdf[features + [target]].dropna()
+    df = tracts_df[features + [target]].dropna()
 
-    X = df[features]
-    y = df[target]
+    # No scaling needed: HistGradientBoostingRegressor bins each feature by its
+    # quantiles, so it gives the same result on raw or min-max scaled values.
+    print("\nPreview of features:")
+    print(df[features].head())
 
-    # 3. Normalize the Features
-    # ML models work best when all features are on a similar scale (e.g., 0 to 1).
-    print("\nNormalizing features using MinMaxScaler...")
-    scaler = MinMaxScaler()
-    X_scaled = scaler.fit_transform(X)
-    
-    # The result is a NumPy array, let's put it back into a DataFrame for clarity
-    X_scaled_df = pd.DataFrame(X_scaled, columns=features, index=X.index)
-    
-    print("Preview of scaled features:")
-    print(X_scaled_df.head())
+    # Plain float32/int32 arrays are half the size of float64 and can be loaded without pickle
+    X = df[features].to_numpy(dtype=np.float32)
+    y = df[target].to_numpy(dtype=np.int32)
 
-    # 4. Split the data into training and testing sets
+    # 3. Split the data into training and testing sets
     # 80% for training the model, 20% for testing its performance on unseen data.
     X_train, X_test, y_train, y_test = train_test_split(
-        X_scaled_df, y, test_size=0.2, random_state=42
+        X, y, test_size=0.2, random_state=42
     )
     print(f"\nData split into training and testing sets:")
     print(f"  Training set size: {len(X_train)} tracts")
     print(f"  Testing set size: {len(X_test)} tracts")
 
-    # 5. Save the prepared data arrays
+    # 4. Save the prepared data arrays
     # We can save these so we don't have to repeat this step every time.
-    # np.savez allows saving multiple arrays into a single file.
+    # np.savez_compressed allows saving multiple arrays into a single (compressed) file.
     output_filename = "ml_ready_data.npz"
-    np.savez(output_filename, 
+    np.savez_compressed(output_filename, 
              X_train=X_train, 
              X_test=X_test, 
              y_train=y_train, 
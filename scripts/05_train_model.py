@@ -1,13 +1,12 @@
 import numpy as np
 import pandas as pd
-import geopandas as gpd
 from sklearn.ensemble import HistGradientBoostingRegressor
 from sklearn.metrics import mean_absolute_error, r2_score
 import matplotlib.pyplot as plt
 
 # --- Configuration ---
 ML_DATA_PATH = "ml_ready_data.npz"
-PROCESSED_DATA_PATH = "final_processed_data.geojson" # Needed for final analysis
+PROCESSED_DATA_PATH = "final_processed_data.parquet" # Needed for final analysis
 # --- End Configuration ---
 
 def main():
@@ -15,7 +14,7 @@ def main():
 
     # 1. Load the prepared data for Machine Learning
     try:
-        data = np.load(ML_DATA_PATH, allow_pickle=True)
+        data = np.load(ML_DATA_PATH)
         X_train = data['X_train']
         X_test = data['X_test']
         y_train = data['y_train']
@@ -28,9 +27,19 @@ def main():
     # 2. Initialize and Train the Model
     print("\nTraining the Gradient Boosting Regressor model...")
     # We use a regressor because we are predicting a number (ShopCount)
-    model = HistGradientBoostingRegressor(random_state=42)
+    # Stop adding trees once the validation loss stops improving
+    model = HistGradientBoostingRegressor(
+        random_state=42,
+        max_iter=500,
+        learning_rate=0.05,
+        early_stopping=True,
+        validation_fraction=0.2,
+        n_iter_no_change=10,
+        tol=1e-3,
+        categorical_features=None,
+    )
     model.fit(X_train, y_train)
-    print("Model training complete.")
+    print(f"Model training complete after {model.n_iter_} iterations.")
 
     # 3. Evaluate Model Performance on the Test Set
     print("\n--- Model Performance Evaluation ---")
@@ -51,17 +60,13 @@ def main():
     print("\n--- Finding Opportunity Hotspots with the Trained Model ---")
     
     # Load the full, original processed dataset to get GEOIDs and other info
-    gdf = gpd.read_file(PROCESSED_DATA_PATH)
     # Prepare the features from the full dataset, just like we did for training
     features = ['TotalPopulation', 'MedianHouseholdIncome', 'MedianAge']
-    full_df = gdf[features + ['ShopCount', 'GEOID']].dropna()
-    
-    from sklearn.preprocessing import MinMaxScaler
-    scaler = MinMaxScaler()
-    X_full_scaled = scaler.fit_transform(full_df[features])
+    tracts_df = pd.read_parquet(PROCESSED_DATA_PATH, columns=features + ['ShopCount', 'GEOID'])
+    full_df = tracts_df[features + ['ShopCount', 'GEOID']].dropna()
     
     # Predict the "expected" shop count for ALL tracts
-    full_df['PredictedShopCount'] = model.predict(X_full_scaled)
+    full_df['PredictedShopCount'] = model.predict(full_df[features].to_numpy(dtype=np.float32))
     
     # Calculate the "Opportunity Score"
     # A high score means the model expected significantly more shops than actually exist.